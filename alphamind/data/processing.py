@@ -18,14 +18,16 @@ def factor_processing(raw_factors: np.ndarray,
                       post_process: Optional[List]=None,
                       groups=None) -> np.ndarray:
 
-    new_factors = raw_factors
+    # the numba kernels below are specialized on dtype and layout, so hand them
+    # one C-contiguous float64 array instead of whatever slice the caller has
+    new_factors = np.ascontiguousarray(raw_factors, dtype=np.float64)
 
     if pre_process:
         for p in pre_process:
             new_factors = p(new_factors, groups=groups)
 
     if risk_factors is not None:
-        risk_factors = risk_factors[:, risk_factors.sum(axis=0) != 0]
+        risk_factors = np.ascontiguousarray(risk_factors[:, risk_factors.sum(axis=0) != 0], dtype=np.float64)
         new_factors = neutralize(risk_factors, new_factors, groups=groups)
 
     if post_process:
@@ -6,6 +6,7 @@ Created on 2017-4-25
 """
 
 import numpy as np
+import numba as nb
 from alphamind.utilities import group_mapping
 from alphamind.utilities import transform
 from alphamind.utilities import aggregate
@@ -15,6 +16,20 @@ from alphamind.utilities import simple_std
 from alphamind.utilities import simple_sqrsum
 
 
+@nb.njit(nogil=True, cache=True)
+def scale_values_1d(x: np.ndarray,
+                    mean_values: np.ndarray,
+                    std_values: np.ndarray) -> np.ndarray:
+    length, width = x.shape
+    res = np.empty((length, width), dtype=np.float64)
+    denominators = np.maximum(std_values, 1e-8)
+
+    for i in range(length):
+        for j in range(width):
+            res[i, j] = (x[i, j] - mean_values[j]) / denominators[j]
+    return res
+
+
 def standardize(x: np.ndarray, groups: np.ndarray=None, ddof=1) -> np.ndarray:
 
     if groups is not None:
@@ -24,7 +39,7 @@ def standardize(x: np.ndarray, groups: np.ndarray=None, ddof=1) -> np.ndarray:
 
         return (x - mean_values) / np.maximum(std_values, 1e-8)
     else:
-        return (x - simple_mean(x, axis=0)) / np.maximum(simple_std(x, axis=0, ddof=ddof), 1e-8)
+        return scale_values_1d(x, simple_mean(x, axis=0), simple_std(x, axis=0, ddof=ddof))
 
 
 def projection(x: np.ndarray, groups: np.ndarray=None, axis=1) -> np.ndarray:
@@ -58,6 +73,8 @@ class Standardizer(object):
         if groups is not None:
             index = array_index(self.labels, groups)
             return (x - self.mean[index]) / np.maximum(self.std[index], 1e-8)
+        elif isinstance(x, np.ndarray) and x.ndim == 2:
+            return scale_values_1d(x, self.mean, self.std)
         else:
             return (x - self.mean) / np.maximum(self.std, 1e-8)
 
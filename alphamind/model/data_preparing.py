@@ -5,11 +5,13 @@ Created on 2017-8-24
 @author: cheng.li
 """
 
-import bisect
+import os
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from typing import Iterable
+from typing import List
 from typing import Union
 from PyFin.api import makeSchedule
 from PyFin.api import BizDayConventions
@@ -21,46 +23,62 @@ from alphamind.data.transformer import Transformer
 from alphamind.data.engines.sqlengine import SqlEngine
 from alphamind.data.engines.universe import Universe
 from alphamind.data.processing import factor_processing
+from alphamind.data.standardize import standardize
+from alphamind.data.standardize import Standardizer
+from alphamind.data.winsorize import winsorize_normal
+from alphamind.data.winsorize import NormalWinsorizer
 from alphamind.data.engines.sqlengine import total_risk_factors
 from alphamind.utilities import alpha_logger
 from alphamind.utilities import map_freq
 
 
-def _merge_df(engine, names, factor_df, target_df, universe, dates, risk_model, neutralized_risk):
-    risk_df = engine.fetch_risk_model_range(universe, dates=dates, risk_model=risk_model)[1]
+# upper bound on the default number of threads batch_processing runs windows on
+_MAX_PROCESSING_WORKERS = 4
+
+
+def _merge_df(names, factor_df, target_df, risk_df, neutralized_risk):
     used_neutralized_risk = list(set(total_risk_factors).difference(names))
     risk_df = risk_df[['trade_date', 'code'] + used_neutralized_risk].dropna()
-    target_df = pd.merge(target_df, risk_df, on=['trade_date', 'code']).dropna()
+    target_df = pd.merge(target_df, risk_df, on=['trade_date', 'code'], sort=False).dropna()
 
     if neutralized_risk:
-        train_x = pd.merge(factor_df, risk_df, on=['trade_date', 'code'])
-        train_y = target_df.copy()
-
-        risk_exp = train_x[neutralized_risk].values.astype(float)
-        x_values = train_x[names].values.astype(float)
-        y_values = train_y[['dx']].values
+        # only the neutralized exposures are read back from train_x, so leave the rest of the risk model behind
+        used_set = set(used_neutralized_risk)
+        risk_cols = [r for r in neutralized_risk if r in used_set]
+        train_x = pd.merge(factor_df,
+                           risk_df[['trade_date', 'code'] + risk_cols],
+                           on=['trade_date', 'code'],
+                           sort=False)
+        train_y = target_df
+
+        risk_exp = train_x[neutralized_risk].values.astype(np.float32, copy=False)
+        x_values = train_x[names].values.astype(np.float32, copy=False)
+        y_values = train_y['dx'].values.astype(np.float32, copy=False).reshape((-1, 1))
     else:
         risk_exp = None
-        train_x = factor_df.copy()
-        train_y = target_df.copy()
-        x_values = train_x[names].values.astype(float)
-        y_values = train_y[['dx']].values
+        train_x = factor_df
+        train_y = target_df
+        x_values = train_x[names].values.astype(np.float32, copy=False)
+        y_values = train_y['dx'].values.astype(np.float32, copy=False).reshape((-1, 1))
 
     codes = train_x['code'].values
-    date_label = pd.DatetimeIndex(factor_df.trade_date).to_pydatetime()
+    date_label = factor_df['trade_date'].values.astype('datetime64[D]')
     dates = np.unique(date_label)
     return target_df, dates, date_label, risk_exp, x_values, y_values, train_x, train_y, codes
 
 
-def prepare_data(engine: SqlEngine,
-                 factors: Union[Transformer, Iterable[object]],
-                 start_date: str,
-                 end_date: str,
-                 frequency: str,
-                 universe: Universe,
-                 benchmark: int,
-                 warm_start: int = 0,
-                 fit_target: Union[Transformer, object]=None):
+def _normalize_keys(df: pd.DataFrame) -> pd.DataFrame:
+    # one canonical dtype per merge key, so the joins hash primitive values of the same type;
+    # int64 holds any code the engine returns, and is a no-op for the usual BigInteger columns
+    df['code'] = df['code'].astype(np.int64, copy=False)
+    df['trade_date'] = pd.to_datetime(df['trade_date'])
+    return df
+
+
+def _prepare_dates(start_date: str,
+                   end_date: str,
+                   frequency: str,
+                   warm_start: int = 0):
     if warm_start > 0:
         p = Period(frequency)
         p = Period(length=-warm_start * p.length(), units=p.units())
@@ -73,44 +91,130 @@ def prepare_data(engine: SqlEngine,
                          dateRule=BizDayConventions.Following,
                          dateGenerationRule=DateGeneration.Forward)
 
-    dates = [d.strftime('%Y-%m-%d') for d in dates]
+    return [d.strftime('%Y-%m-%d') for d in dates]
 
-    horizon = map_freq(frequency)
-
-    if isinstance(factors, Transformer):
-        transformer = factors
-    else:
-        transformer = Transformer(factors)
-
-    factor_df = engine.fetch_factor_range(universe,
-                                          factors=transformer,
-                                          dates=dates).sort_values(['trade_date', 'code'])
-    alpha_logger.info("factor data loading finished")
 
+def _fetch_target_df(engine: SqlEngine,
+                     universe: Universe,
+                     dates: List[str],
+                     frequency: str,
+                     fit_target: Union[Transformer, object]=None):
     if fit_target is None:
+        horizon = map_freq(frequency)
         target_df = engine.fetch_dx_return_range(universe, dates=dates, horizon=horizon)
     else:
         one_more_date = advanceDateByCalendar('china.sse', dates[-1], frequency)
         target_df = engine.fetch_factor_range_forward(universe, factors=fit_target, dates=dates + [one_more_date])
         target_df = target_df[target_df.trade_date.isin(dates)]
         target_df = target_df.groupby('code').apply(lambda x: x.fillna(method='pad'))
-    alpha_logger.info("fit target data loading finished")
+    return target_df
 
-    industry_df = engine.fetch_industry_range(universe, dates=dates)
-    alpha_logger.info("industry data loading finished")
-    benchmark_df = engine.fetch_benchmark_range(benchmark, dates=dates)
-    alpha_logger.info("benchmark data loading finished")
 
-    df = pd.merge(factor_df, target_df, on=['trade_date', 'code']).dropna()
-    df = pd.merge(df, benchmark_df, on=['trade_date', 'code'], how='left')
-    df = pd.merge(df, industry_df, on=['trade_date', 'code'])
+def prepare_data(engine: SqlEngine,
+                 factors: Union[Transformer, Iterable[object]],
+                 start_date: str,
+                 end_date: str,
+                 frequency: str,
+                 universe: Universe,
+                 benchmark: int,
+                 warm_start: int = 0,
+                 fit_target: Union[Transformer, object]=None):
+    dates = _prepare_dates(start_date, end_date, frequency, warm_start)
+
+    if isinstance(factors, Transformer):
+        transformer = factors
+    else:
+        transformer = Transformer(factors)
+
+    target_df, factor_df = _fetch_frames(engine, transformer, dates, frequency, universe, benchmark, fit_target)
+    return dates, target_df, factor_df
+
+
+def _fetch_frames(engine: SqlEngine,
+                  transformer: Transformer,
+                  dates: List[str],
+                  frequency: str,
+                  universe: Universe,
+                  benchmark: int,
+                  fit_target: Union[Transformer, object]=None):
+    # the queries are independent round trips, each checking out its own pooled connection
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        factor_future = executor.submit(engine.fetch_factor_range, universe, factors=transformer, dates=dates)
+        target_future = executor.submit(_fetch_target_df, engine, universe, dates, frequency, fit_target)
+        industry_future = executor.submit(engine.fetch_industry_range, universe, dates=dates)
+        benchmark_future = executor.submit(engine.fetch_benchmark_range, benchmark, dates=dates)
+
+        factor_df = _normalize_keys(factor_future.result()).sort_values(['trade_date', 'code'])
+        alpha_logger.info("factor data loading finished")
+        target_df = _normalize_keys(target_future.result())
+        alpha_logger.info("fit target data loading finished")
+        industry_df = _normalize_keys(industry_future.result())
+        alpha_logger.info("industry data loading finished")
+        benchmark_df = _normalize_keys(benchmark_future.result())
+        alpha_logger.info("benchmark data loading finished")
+
+    # inner joins first so the left join on the benchmark only sees the surviving rows
+    industry_df = industry_df[['trade_date', 'code', 'industry_code', 'industry']]
+    benchmark_df = benchmark_df[['trade_date', 'code', 'weight']]
+
+    df = pd.merge(factor_df, industry_df, on=['trade_date', 'code'], sort=False)
+    df = pd.merge(df, target_df, on=['trade_date', 'code'], sort=False).dropna()
+    df = pd.merge(df, benchmark_df, on=['trade_date', 'code'], how='left', sort=False)
     df['weight'] = df['weight'].fillna(0.)
-    df.dropna(inplace=True)
 
-    return dates, df[['trade_date', 'code', 'dx']], df[
+    return df[['trade_date', 'code', 'dx']], df[
         ['trade_date', 'code', 'weight', 'industry_code', 'industry'] + transformer.names]
 
 
+def _is_column_wise(processors) -> bool:
+    if not processors:
+        return True
+    return all(p in (winsorize_normal, standardize) or isinstance(p, (NormalWinsorizer, Standardizer))
+               for p in processors)
+
+
+def _process_window(left_index,
+                    right_index,
+                    x_values,
+                    y_values,
+                    risk_exp,
+                    pre_process,
+                    post_process):
+    this_raw_x = x_values[left_index:right_index]
+    this_raw_y = y_values[left_index:right_index]
+
+    if risk_exp is not None:
+        this_risk_exp = risk_exp[left_index:right_index]
+    else:
+        this_risk_exp = None
+
+    if len(this_raw_y) == len(this_raw_x) > 0 \
+            and _is_column_wise(pre_process) and _is_column_wise(post_process):
+        # every step treats columns independently and neutralize regresses each
+        # column on the same exposures, so x and y share a single pass
+        ne = factor_processing(np.concatenate([this_raw_x, this_raw_y], axis=1),
+                               pre_process=pre_process,
+                               risk_factors=this_risk_exp,
+                               post_process=post_process)
+        width = this_raw_x.shape[1]
+        return ne[:, :width], ne[:, width:]
+
+    ne_x = factor_processing(this_raw_x,
+                             pre_process=pre_process,
+                             risk_factors=this_risk_exp,
+                             post_process=post_process)
+
+    if len(this_raw_y) > 0:
+        ne_y = factor_processing(this_raw_y,
+                                 pre_process=pre_process,
+                                 risk_factors=this_risk_exp,
+                                 post_process=post_process)
+    else:
+        ne_y = None
+
+    return ne_x, ne_y
+
+
 def batch_processing(names,
                      x_values,
                      y_values,
@@ -120,83 +224,82 @@ def batch_processing(names,
                      risk_exp,
                      pre_process,
                      post_process,
-                     codes):
-    train_x_buckets = {}
-    train_y_buckets = {}
-    train_risk_buckets = {}
-    predict_x_buckets = {}
-    predict_y_buckets = {}
-    predict_risk_buckets = {}
-    predict_codes_bucket = {}
-
-    for i, start in enumerate(groups[:-batch]):
-        end = groups[i + batch]
-
-        left_index = bisect.bisect_left(group_label, start)
-        right_index = bisect.bisect_left(group_label, end)
-
-        this_raw_x = x_values[left_index:right_index]
-        this_raw_y = y_values[left_index:right_index]
+                     codes,
+                     max_workers: int = None):
+    ends = groups[batch:]
+    n = len(ends)
+    train_x_buckets = [None] * n
+    train_y_buckets = [None] * n
+    train_risk_buckets = [None] * n
+    predict_x_buckets = [None] * n
+    predict_y_buckets = [None] * n
+    predict_risk_buckets = [None] * n
+    predict_codes_bucket = [None] * n
+
+    # training set of a bucket is [start, end) and its prediction set is (start, end];
+    # when groups are the dates present in group_label, the latter is the training set
+    # of the next bucket, so every distinct window only goes through the pipeline once
+
+    # search on epoch days so the comparisons run on plain int64
+    label_days = np.asarray(group_label).astype('datetime64[D]', copy=False).view('i8')
+    group_days = np.asarray(groups).astype('datetime64[D]', copy=False).view('i8')
+    date_starts = np.searchsorted(label_days, group_days, side='left').tolist()
+    date_ends = np.searchsorted(label_days, group_days, side='right').tolist()
+    train_bounds = list(zip(date_starts[:-batch], date_starts[batch:]))
+    predict_bounds = list(zip(date_ends[:-batch], date_ends[batch:]))
+    windows = sorted(set(train_bounds + predict_bounds))
+
+    # windows are independent and the processing kernels release the GIL,
+    # so a thread pool shares the arrays without pickling them to workers;
+    # neutralize already runs multi-threaded BLAS inside each window, so the
+    # default stays at a few workers rather than one per core
+    if max_workers is None:
+        max_workers = min(_MAX_PROCESSING_WORKERS, os.cpu_count() or 1)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {w: executor.submit(_process_window,
+                                      w[0],
+                                      w[1],
+                                      x_values,
+                                      y_values,
+                                      risk_exp,
+                                      pre_process,
+                                      post_process) for w in windows}
+        processed = {w: f.result() for w, f in futures.items()}
+
+    for i, end in enumerate(ends):
+        left_index, right_index = train_bounds[i]
+        ne_x, ne_y = processed[train_bounds[i]]
+        train_x_buckets[i] = pd.DataFrame(ne_x, columns=names)
+        train_y_buckets[i] = ne_y
 
         if risk_exp is not None:
-            this_risk_exp = risk_exp[left_index:right_index]
-        else:
-            this_risk_exp = None
-
-        train_x_buckets[end] = pd.DataFrame(factor_processing(this_raw_x,
-                                                              pre_process=pre_process,
-                                                              risk_factors=this_risk_exp,
-                                                              post_process=post_process),
-                                            columns=names)
-
-        train_y_buckets[end] = factor_processing(this_raw_y,
-                                                 pre_process=pre_process,
-                                                 risk_factors=this_risk_exp,
-                                                 post_process=post_process)
-
-        train_risk_buckets[end] = this_risk_exp
+            train_risk_buckets[i] = risk_exp[left_index:right_index]
 
-        left_index = bisect.bisect_right(group_label, start)
-        right_index = bisect.bisect_right(group_label, end)
-
-        sub_dates = group_label[left_index:right_index]
-        this_raw_x = x_values[left_index:right_index]
-        this_codes = codes[left_index:right_index]
+        left_index, right_index = predict_bounds[i]
+        ne_x, ne_y = processed[predict_bounds[i]]
 
+        # the window is shared with the next bucket's training set,
+        # so the end-day rows are copied to keep the buckets independent
+        inner_left_index = date_starts[i + batch]
+        inner_right_index = date_ends[i + batch]
+        day_slice = slice(inner_left_index - left_index, inner_right_index - left_index)
+        predict_x_buckets[i] = pd.DataFrame(ne_x[day_slice].copy(), columns=names)
         if risk_exp is not None:
-            this_risk_exp = risk_exp[left_index:right_index]
-        else:
-            this_risk_exp = None
+            predict_risk_buckets[i] = risk_exp[inner_left_index:inner_right_index]
+        predict_codes_bucket[i] = codes[inner_left_index:inner_right_index]
 
-        ne_x = factor_processing(this_raw_x,
-                                 pre_process=pre_process,
-                                 risk_factors=this_risk_exp,
-                                 post_process=post_process)
+        if ne_y is not None:
+            predict_y_buckets[i] = ne_y[day_slice].copy()
 
-        inner_left_index = bisect.bisect_left(sub_dates, end)
-        inner_right_index = bisect.bisect_right(sub_dates, end)
-        predict_x_buckets[end] = pd.DataFrame(ne_x[inner_left_index:inner_right_index], columns=names)
-        if risk_exp is not None:
-            predict_risk_buckets[end] = this_risk_exp[inner_left_index:inner_right_index]
-        else:
-            predict_risk_buckets = None
-        predict_codes_bucket[end] = this_codes[inner_left_index:inner_right_index]
-
-        this_raw_y = y_values[left_index:right_index]
-        if len(this_raw_y) > 0:
-            ne_y = factor_processing(this_raw_y,
-                                     pre_process=pre_process,
-                                     risk_factors=this_risk_exp,
-                                     post_process=post_process)
-            predict_y_buckets[end] = ne_y[inner_left_index:inner_right_index]
-
-    return train_x_buckets, \
-           train_y_buckets, \
-           train_risk_buckets, \
-           predict_x_buckets, \
-           predict_y_buckets, \
-           predict_risk_buckets, \
-           predict_codes_bucket
+    keys = pd.DatetimeIndex(ends).to_pydatetime()
+    return dict(zip(keys, train_x_buckets)), \
+           dict(zip(keys, train_y_buckets)), \
+           dict(zip(keys, train_risk_buckets)), \
+           dict(zip(keys, predict_x_buckets)), \
+           {k: y for k, y in zip(keys, predict_y_buckets) if y is not None}, \
+           dict(zip(keys, predict_risk_buckets)) if risk_exp is not None else None, \
+           dict(zip(keys, predict_codes_bucket))
 
 
 def fetch_data_package(engine: SqlEngine,
@@ -216,18 +319,23 @@ def fetch_data_package(engine: SqlEngine,
     alpha_logger.info("Starting data package fetching ...")
     transformer = Transformer(alpha_factors)
     names = transformer.names
-    dates, target_df, factor_df = prepare_data(engine,
-                                               transformer,
-                                               start_date,
-                                               end_date,
-                                               frequency,
-                                               universe,
-                                               benchmark,
-                                               warm_start + batch,
-                                               fit_target=fit_target)
+    dates = _prepare_dates(start_date, end_date, frequency, warm_start + batch)
+
+    # the risk model query does not depend on prepare_data, so overlap it with the other fetches
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        risk_future = executor.submit(engine.fetch_risk_model_range, universe, dates=dates, risk_model=risk_model)
+        target_df, factor_df = _fetch_frames(engine,
+                                             transformer,
+                                             dates,
+                                             frequency,
+                                             universe,
+                                             benchmark,
+                                             fit_target=fit_target)
+        risk_df = _normalize_keys(risk_future.result()[1])
+    alpha_logger.info("risk model data loading finished")
 
     target_df, dates, date_label, risk_exp, x_values, y_values, train_x, train_y, codes = \
-        _merge_df(engine, names, factor_df, target_df, universe, dates, risk_model, neutralized_risk)
+        _merge_df(names, factor_df, target_df, risk_df, neutralized_risk)
 
     alpha_logger.info("data merging finished")
 
@@ -236,8 +344,14 @@ def fetch_data_package(engine: SqlEngine,
     target_df['industry_code'] = train_x['industry_code']
 
     if neutralized_risk:
-        for i, name in enumerate(neutralized_risk):
-            target_df.loc[:, name] = risk_exp[:, i]
+        # exposures from the risk model already came in with the merge in _merge_df;
+        # only those taken from the alpha factors themselves still need joining
+        missing = [(i, name) for i, name in enumerate(neutralized_risk) if name not in target_df.columns]
+        if missing:
+            risk_frame = pd.DataFrame(risk_exp[:, [i for i, _ in missing]],
+                                      index=target_df.index,
+                                      columns=[name for _, name in missing])
+            target_df = target_df.join(risk_frame)
 
     alpha_logger.info("Loading data is finished")
 
@@ -307,7 +421,7 @@ def fetch_train_phase(engine,
 
     horizon = map_freq(frequency)
 
-    factor_df = engine.fetch_factor_range(universe, factors=transformer, dates=dates)
+    factor_df = engine.fetch_factor_range(universe, factors=transformer, dates=dates).sort_values(['trade_date', 'code'])
     if fit_target is None:
         target_df = engine.fetch_dx_return_range(universe, dates=dates, horizon=horizon)
     else:
@@ -321,10 +435,11 @@ def fetch_train_phase(engine,
     target_df, factor_df = df[['trade_date', 'code', 'dx']], df[
         ['trade_date', 'code'] + transformer.names]
 
+    risk_df = engine.fetch_risk_model_range(universe, dates=dates, risk_model=risk_model)[1]
     target_df, dates, date_label, risk_exp, x_values, y_values, _, _, codes = \
-        _merge_df(engine, transformer.names, factor_df, target_df, universe, dates, risk_model, neutralized_risk)
+        _merge_df(transformer.names, factor_df, target_df, risk_df, neutralized_risk)
 
-    if dates[-1] == dt.datetime.strptime(ref_date, '%Y-%m-%d'):
+    if dates[-1] == np.datetime64(ref_date, 'D'):
         pyFinAssert(len(dates) >= 2, ValueError, "No previous data for training for the date {0}".format(ref_date))
         end = dates[-2]
         start = dates[-batch - 1] if batch <= len(dates) - 1 else dates[0]
@@ -332,12 +447,13 @@ def fetch_train_phase(engine,
         end = dates[-1]
         start = dates[-batch] if batch <= len(dates) else dates[0]
 
-    index = (date_label >= start) & (date_label <= end)
-    this_raw_x = x_values[index]
-    this_raw_y = y_values[index]
-    this_code = codes[index]
+    left_index = np.searchsorted(date_label, start, side='left')
+    right_index = np.searchsorted(date_label, end, side='right')
+    this_raw_x = x_values[left_index:right_index]
+    this_raw_y = y_values[left_index:right_index]
+    this_code = codes[left_index:right_index]
     if risk_exp is not None:
-        this_risk_exp = risk_exp[index]
+        this_risk_exp = risk_exp[left_index:right_index]
     else:
         this_risk_exp = None
 
@@ -429,8 +545,8 @@ def fetch_predict_phase(engine,
         end = dates[-1]
         start = dates[-batch] if batch <= len(dates) else dates[0]
 
-        left_index = bisect.bisect_left(date_label, start)
-        right_index = bisect.bisect_right(date_label, end)
+        left_index = np.searchsorted(date_label, start, side='left')
+        right_index = np.searchsorted(date_label, end, side='right')
         this_raw_x = x_values[left_index:right_index]
         this_raw_y = y_values[left_index:right_index]
         sub_dates = date_label[left_index:right_index]
@@ -450,14 +566,14 @@ def fetch_predict_phase(engine,
                                  risk_factors=this_risk_exp,
                                  post_process=post_process)
 
-        inner_left_index = bisect.bisect_left(sub_dates, end)
-        inner_right_index = bisect.bisect_right(sub_dates, end)
+        inner_left_index = np.searchsorted(sub_dates, end, side='left')
+        inner_right_index = np.searchsorted(sub_dates, end, side='right')
 
         ne_x = ne_x[inner_left_index:inner_right_index]
         ne_y = ne_y[inner_left_index:inner_right_index]
 
-        left_index = bisect.bisect_left(date_label, end)
-        right_index = bisect.bisect_right(date_label, end)
+        left_index = np.searchsorted(date_label, end, side='left')
+        right_index = np.searchsorted(date_label, end, side='right')
 
         codes = train_x.code.values[left_index:right_index]
     else:
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-14
+
+@author: agent
+"""
+
+import unittest
+import numpy as np
+from alphamind.data.processing import factor_processing
+from alphamind.data.standardize import standardize
+from alphamind.data.winsorize import winsorize_normal
+
+
+class TestProcessing(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.randn(3000, 10)
+        self.risk = np.random.randn(3000, 4)
+
+    def test_factor_processing_with_float32_input(self):
+        x = self.x.astype(np.float32)
+        risk = self.risk.astype(np.float32)
+        calc_res = factor_processing(x,
+                                     pre_process=[winsorize_normal, standardize],
+                                     risk_factors=risk,
+                                     post_process=[standardize])
+        exp_res = factor_processing(x.astype(np.float64),
+                                    pre_process=[winsorize_normal, standardize],
+                                    risk_factors=risk.astype(np.float64),
+                                    post_process=[standardize])
+
+        self.assertEqual(calc_res.dtype, np.float64)
+        np.testing.assert_array_almost_equal(calc_res, exp_res)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -56,6 +56,23 @@ class TestStandardize(unittest.TestCase):
         np.testing.assert_array_almost_equal(calc_zscore, exp_zscore)
         np.testing.assert_array_almost_equal(s(self.x), exp_zscore)
 
+    def test_standardizer_with_single_row(self):
+        s = Standardizer()
+        s.fit(self.x)
+        calc_zscore = s.transform(self.x[0])
+
+        exp_zscore = standardize(self.x)[0]
+        np.testing.assert_array_almost_equal(calc_zscore, exp_zscore)
+
+    def test_standardizer_with_data_frame(self):
+        s = Standardizer()
+        s.fit(self.x)
+        calc_zscore = s.transform(pd.DataFrame(self.x))
+
+        exp_zscore = standardize(self.x)
+        self.assertIsInstance(calc_zscore, pd.DataFrame)
+        np.testing.assert_array_almost_equal(calc_zscore.values, exp_zscore)
+
     def test_grouped_standardizer(self):
         s = Standardizer()
         s.fit(self.x, self.groups)
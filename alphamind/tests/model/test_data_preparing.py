@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-14
+
+@author: agent
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+from alphamind.data.engines.sqlengine import total_risk_factors
+from alphamind.data.processing import factor_processing
+from alphamind.data.rank import rank
+from alphamind.data.standardize import standardize
+from alphamind.data.winsorize import winsorize_normal
+from alphamind.model.data_preparing import batch_processing
+from alphamind.model.data_preparing import fetch_data_package
+from alphamind.model.data_preparing import prepare_data
+
+
+def _bucket_reference(x_values, y_values, groups, group_label, batch, risk_exp, pre_process, post_process, codes):
+    # plain per-bucket loop: every window is processed on its own, x and y separately
+    train_x, train_y, predict_x, predict_y, predict_codes = {}, {}, {}, {}, {}
+
+    def process(values, left_index, right_index):
+        this_risk_exp = risk_exp[left_index:right_index] if risk_exp is not None else None
+        return factor_processing(values[left_index:right_index],
+                                 pre_process=pre_process,
+                                 risk_factors=this_risk_exp,
+                                 post_process=post_process)
+
+    for i, start in enumerate(groups[:-batch]):
+        end = groups[i + batch]
+
+        left_index = np.searchsorted(group_label, start, side='left')
+        right_index = np.searchsorted(group_label, end, side='left')
+        train_x[end] = process(x_values, left_index, right_index)
+        train_y[end] = process(y_values, left_index, right_index)
+
+        left_index = np.searchsorted(group_label, start, side='right')
+        right_index = np.searchsorted(group_label, end, side='right')
+        sub_dates = group_label[left_index:right_index]
+        inner_left_index = np.searchsorted(sub_dates, end, side='left')
+        inner_right_index = np.searchsorted(sub_dates, end, side='right')
+        predict_x[end] = process(x_values, left_index, right_index)[inner_left_index:inner_right_index]
+        predict_codes[end] = codes[left_index:right_index][inner_left_index:inner_right_index]
+        if len(y_values[left_index:right_index]) > 0:
+            predict_y[end] = process(y_values, left_index, right_index)[inner_left_index:inner_right_index]
+
+    return train_x, train_y, predict_x, predict_y, predict_codes
+
+
+class FakeEngine(object):
+
+    def __init__(self, dates, codes):
+        rng = np.random.RandomState(42)
+        panel = pd.MultiIndex.from_product([pd.to_datetime(dates), codes],
+                                           names=['trade_date', 'code']).to_frame(index=False)
+        self.panel = panel[rng.rand(len(panel)) > 0.05].reset_index(drop=True)
+        for name in ['f1', 'f2', 'dx'] + total_risk_factors:
+            self.panel[name] = rng.randn(len(self.panel))
+        self.panel['weight'] = np.where(rng.rand(len(self.panel)) > 0.5, rng.rand(len(self.panel)) / 100., np.nan)
+        self.panel['industry_code'] = self.panel.code % 5
+        self.panel['industry'] = 'ind' + self.panel['industry_code'].astype(str)
+        self.queried_dates = []
+
+    def _fetch(self, dates, columns):
+        self.queried_dates.append(list(dates))
+        df = self.panel[self.panel.trade_date.isin(pd.to_datetime(dates))]
+        return df[['trade_date', 'code'] + columns].dropna().reset_index(drop=True)
+
+    def fetch_factor_range(self, universe, factors, dates):
+        return self._fetch(dates, factors.names)
+
+    def fetch_dx_return_range(self, universe, dates, horizon):
+        return self._fetch(dates, ['dx'])
+
+    def fetch_industry_range(self, universe, dates):
+        return self._fetch(dates, ['industry_code', 'industry'])
+
+    def fetch_benchmark_range(self, benchmark, dates):
+        return self._fetch(dates, ['weight'])
+
+    def fetch_risk_model_range(self, universe, dates, risk_model):
+        return None, self._fetch(dates, total_risk_factors)
+
+
+class TestDataPreparing(unittest.TestCase):
+
+    def setUp(self):
+        self.names = ['a', 'b', 'c']
+        dates = pd.bdate_range('2017-01-02', periods=12).values.astype('datetime64[D]')
+        sizes = np.random.randint(30, 50, len(dates))
+        self.date_label = np.repeat(dates, sizes)
+        self.dates = np.unique(self.date_label)
+        self.codes = np.concatenate([np.arange(s) for s in sizes])
+        n = len(self.date_label)
+        self.x = np.random.randn(n, len(self.names))
+        self.y = np.random.randn(n, 1)
+        self.risk_exp = np.concatenate([np.ones((n, 1)), np.random.randn(n, 2)], axis=1)
+
+    def test_batch_processing_buckets_independent(self):
+        buckets = batch_processing(self.names,
+                                   self.x,
+                                   self.y,
+                                   self.dates,
+                                   self.date_label,
+                                   2,
+                                   self.risk_exp,
+                                   [winsorize_normal, standardize],
+                                   [standardize],
+                                   self.codes)
+        train_x, train_y, _, predict_x, predict_y, _, _ = buckets
+
+        for predict_date in predict_x:
+            for train_date in train_x:
+                self.assertFalse(np.shares_memory(predict_x[predict_date].values, train_x[train_date].values))
+                self.assertFalse(np.shares_memory(predict_y[predict_date], train_y[train_date]))
+
+    def _check_batch_processing(self, x, y, batch, risk_exp, pre_process, post_process, max_workers=None):
+        names = self.names[:x.shape[1]]
+        train_x, train_y, train_risk, predict_x, predict_y, predict_risk, predict_codes = \
+            batch_processing(names,
+                             x,
+                             y,
+                             self.dates,
+                             self.date_label,
+                             batch,
+                             risk_exp,
+                             pre_process,
+                             post_process,
+                             self.codes,
+                             max_workers=max_workers)
+
+        expected = _bucket_reference(x,
+                                     y,
+                                     self.dates,
+                                     self.date_label,
+                                     batch,
+                                     risk_exp,
+                                     pre_process,
+                                     post_process,
+                                     self.codes)
+        exp_train_x, exp_train_y, exp_predict_x, exp_predict_y, exp_predict_codes = expected
+
+        self.assertEqual(len(train_x), len(self.dates) - batch)
+        for end in exp_train_x:
+            key = pd.Timestamp(end).to_pydatetime()
+            self.assertEqual(list(train_x[key].columns), names)
+            np.testing.assert_array_almost_equal(train_x[key].values, exp_train_x[end])
+            np.testing.assert_array_almost_equal(train_y[key], exp_train_y[end])
+            np.testing.assert_array_almost_equal(predict_x[key].values, exp_predict_x[end])
+            np.testing.assert_array_equal(predict_codes[key], exp_predict_codes[end])
+            if end in exp_predict_y:
+                np.testing.assert_array_almost_equal(predict_y[key], exp_predict_y[end])
+            else:
+                self.assertNotIn(key, predict_y)
+
+            if risk_exp is not None:
+                left_index = np.searchsorted(self.date_label, end, side='left')
+                right_index = np.searchsorted(self.date_label, end, side='right')
+                np.testing.assert_array_equal(predict_risk[key], risk_exp[left_index:right_index])
+                self.assertEqual(len(train_risk[key]), len(train_x[key]))
+
+        if risk_exp is None:
+            self.assertIsNone(predict_risk)
+        self.assertEqual(len(predict_y), len(exp_predict_y))
+
+    def test_batch_processing(self):
+        for batch in (1, 3):
+            for risk_exp in (None, self.risk_exp):
+                self._check_batch_processing(self.x,
+                                             self.y,
+                                             batch,
+                                             risk_exp,
+                                             [winsorize_normal, standardize],
+                                             [standardize])
+
+    def test_batch_processing_with_single_worker(self):
+        self._check_batch_processing(self.x,
+                                     self.y,
+                                     2,
+                                     self.risk_exp,
+                                     [winsorize_normal, standardize],
+                                     [standardize],
+                                     max_workers=1)
+
+    def test_batch_processing_with_shorter_y(self):
+        # the last prediction window holds fewer targets than factors, so x and y cannot share a pass
+        self._check_batch_processing(self.x,
+                                     self.y[:-10],
+                                     2,
+                                     None,
+                                     [winsorize_normal, standardize],
+                                     [standardize])
+
+    def test_batch_processing_with_rank(self):
+        # rank is not column-wise, so x and y go through factor_processing separately
+        for risk_exp in (None, self.risk_exp):
+            self._check_batch_processing(self.x[:, :1],
+                                         self.y,
+                                         2,
+                                         risk_exp,
+                                         [rank],
+                                         [standardize])
+
+    def test_batch_processing_with_mixed_date_units(self):
+        # breakpoints are searched on epoch days, whatever the resolution the labels come in
+        args = (self.names, self.x, self.y)
+        kwargs = dict(batch=2,
+                      risk_exp=self.risk_exp,
+                      pre_process=[winsorize_normal, standardize],
+                      post_process=[standardize],
+                      codes=self.codes)
+        expected = batch_processing(*args, groups=self.dates, group_label=self.date_label, **kwargs)
+        calculated = batch_processing(*args,
+                                      groups=self.dates.astype('datetime64[ns]'),
+                                      group_label=self.date_label.astype('datetime64[ns]'),
+                                      **kwargs)
+
+        for calc_buckets, exp_buckets in zip(calculated, expected):
+            self.assertEqual(list(calc_buckets), list(exp_buckets))
+            for key in exp_buckets:
+                np.testing.assert_array_equal(np.asarray(calc_buckets[key]), np.asarray(exp_buckets[key]))
+
+    def test_prepare_data(self):
+        calendar = pd.bdate_range('2016-12-01', '2017-04-28').strftime('%Y-%m-%d').tolist()
+        engine = FakeEngine(calendar, np.arange(1, 51))
+
+        dates, target_df, factor_df = prepare_data(engine, ['f1', 'f2'], '2017-01-03', '2017-03-31', '1w', None, 905)
+        for queried in engine.queried_dates:
+            self.assertEqual(queried, dates)
+
+        df = pd.merge(engine.panel[['trade_date', 'code', 'f1', 'f2']],
+                      engine.panel[['trade_date', 'code', 'dx']],
+                      on=['trade_date', 'code'])
+        df = df[df.trade_date.isin(pd.to_datetime(dates))]
+        df = pd.merge(df, engine.panel[['trade_date', 'code', 'weight']], on=['trade_date', 'code'], how='left')
+        df = pd.merge(df, engine.panel[['trade_date', 'code', 'industry_code', 'industry']], on=['trade_date', 'code'])
+        df['weight'] = df['weight'].fillna(0.)
+        df = df.sort_values(['trade_date', 'code']).reset_index(drop=True)
+
+        pd.testing.assert_frame_equal(target_df.reset_index(drop=True), df[['trade_date', 'code', 'dx']])
+        pd.testing.assert_frame_equal(factor_df.reset_index(drop=True),
+                                      df[['trade_date', 'code', 'weight', 'industry_code', 'industry', 'f1', 'f2']])
+
+    def test_prepare_data_with_wide_codes(self):
+        calendar = pd.bdate_range('2016-12-01', '2017-04-28').strftime('%Y-%m-%d').tolist()
+        codes = np.arange(1, 51) + 3000000000
+        engine = FakeEngine(calendar, codes)
+
+        _, target_df, factor_df = prepare_data(engine, ['f1', 'f2'], '2017-01-03', '2017-03-31', '1w', None, 905)
+        self.assertEqual(factor_df['code'].dtype, np.int64)
+        self.assertTrue(np.isin(factor_df['code'].values, codes).all())
+        np.testing.assert_array_equal(target_df['code'].values, factor_df['code'].values)
+
+    def test_fetch_data_package_queries_one_schedule(self):
+        calendar = pd.bdate_range('2016-12-01', '2017-04-28').strftime('%Y-%m-%d').tolist()
+        engine = FakeEngine(calendar, np.arange(1, 51))
+
+        fetch_data_package(engine, ['f1', 'f2'], '2017-02-01', '2017-03-31', '1w', None, 905, warm_start=1, batch=2)
+        self.assertEqual(len(engine.queried_dates), 5)
+        for queried in engine.queried_dates[1:]:
+            self.assertEqual(queried, engine.queried_dates[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
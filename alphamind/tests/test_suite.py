@@ -26,6 +26,7 @@ if __name__ == '__main__':
     from alphamind.tests.data.test_standardize import TestStandardize
     from alphamind.tests.data.test_winsorize import TestWinsorize
     from alphamind.tests.data.test_quantile import TestQuantile
+    from alphamind.tests.data.test_processing import TestProcessing
     from alphamind.tests.data.engines.test_sql_engine import TestSqlEngine
     from alphamind.tests.data.engines.test_universe import TestUniverse
     from alphamind.tests.portfolio.test_constraints import TestConstraints
@@ -46,6 +47,7 @@ if __name__ == '__main__':
     from alphamind.tests.model.test_treemodel import TestTreeModel
     from alphamind.tests.model.test_loader import TestLoader
     from alphamind.tests.model.test_composer import TestComposer
+    from alphamind.tests.model.test_data_preparing import TestDataPreparing
     from alphamind.tests.execution.test_naiveexecutor import TestNaiveExecutor
     from alphamind.tests.execution.test_thresholdexecutor import TestThresholdExecutor
     from alphamind.tests.execution.test_targetvolexecutor import TestTargetVolExecutor
@@ -56,6 +58,7 @@ if __name__ == '__main__':
                          TestStandardize,
                          TestWinsorize,
                          TestQuantile,
+                         TestProcessing,
                          TestSqlEngine,
                          TestUniverse,
                          TestConstraints,
@@ -76,6 +79,7 @@ if __name__ == '__main__':
                          TestTreeModel,
                          TestLoader,
                          TestComposer,
+                         TestDataPreparing,
                          TestNaiveExecutor,
                          TestThresholdExecutor,
                          TestTargetVolExecutor,
@@ -16,21 +16,20 @@ import numba as nb
 alpha_logger = CustomLogger('ALPHA_MIND', 'info')
 
 
+_FREQ_HORIZONS = {'1d': 0,
+                  '1w': 4,
+                  '2w': 9,
+                  '3w': 14,
+                  '4w': 19,
+                  '1m': 21}
+
+
 def map_freq(freq):
 
-    if freq == '1m':
-        horizon = 21
-    elif freq == '1w':
-        horizon = 4
-    elif freq == '2w':
-        horizon = 9
-    elif freq == '3w':
-        horizon = 14
-    elif freq == '4w':
-        horizon = 19
-    elif freq == '1d':
-        horizon = 0
-    elif freq[-1] == "b":
+    if freq in _FREQ_HORIZONS:
+        return _FREQ_HORIZONS[freq]
+
+    if freq[-1] == "b":
         horizon = int(freq[:-1]) - 1
     else:
         raise ValueError("Unrecognized freq: {0}".format(freq))